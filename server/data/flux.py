@@ -26,6 +26,9 @@ def empty_flux() -> Flux:
 # Amount of time subtracted form the auto refresh horizon to account for timing inaccuracies
 _AUTO_REFRESH_SLACK = timedelta(minutes=2)
 
+# Maximum rows sent per COPY so large imports regularly yield to the event loop
+_IMPORT_BATCH_SIZE = 50_000
+
 
 class _Resolution(Enum):
     # Add R_ prefix because identifiers cannot start with a number
@@ -122,18 +125,27 @@ async def fetch_flux(
         ''',
         interval, start, end
     )
-    return empty_flux() if len(records) == 0 else pd.DataFrame(
-        records,
-        columns=[FLUX_INDEX_NAME, FLUX_VALUE_NAME]
-    ).set_index(FLUX_INDEX_NAME)[FLUX_VALUE_NAME]
+    if len(records) == 0:
+        return empty_flux()
+    # Build the series directly instead of going through an intermediate dataframe
+    return pd.Series(
+        np.fromiter((record[1] for record in records), dtype=np.float64, count=len(records)),
+        name=FLUX_VALUE_NAME,
+        index=pd.DatetimeIndex([record[0] for record in records], name=FLUX_INDEX_NAME),
+    )
 
 
 async def import_flux(connection: Connection, source: FluxSource, flux: Flux):
     if len(flux) == 0:
         return
-    await connection.copy_records_to_table(
-        source.table_name, records=flux.items()
-    )
+    async with connection.transaction():
+        for batch_start in range(0, len(flux), _IMPORT_BATCH_SIZE):
+            batch = flux.iloc[batch_start:batch_start + _IMPORT_BATCH_SIZE]
+            await connection.copy_records_to_table(
+                source.table_name,
+                # Convert in bulk instead of boxing every row into pandas/numpy scalars
+                records=zip(batch.index.to_pydatetime(), batch.tolist())
+            )
 
     now = datetime.now(timezone.utc)
     start = flux.index[0]
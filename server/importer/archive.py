@@ -1,14 +1,19 @@
 import asyncio
+import os
+import random
 import warnings
-from asyncio import Future, Semaphore
+from asyncio import Future, Semaphore, Queue, Task, AbstractEventLoop
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from datetime import timedelta, datetime, timezone, time
-from pathlib import Path
-from typing import Callable, TypeVar, Any
+from functools import partial
+from typing import Callable, TypeVar, Any, Iterable, Generator, Union
 
+import numpy as np
 import pandas as pd
 from asyncpg import Connection
 from parfive import Results
+from parfive.utils import FailedDownload, MultiPartDownloadError
 from sunpy.net import Fido, attrs
 from sunpy.net.base_client import QueryResponseRow
 from sunpy.net.dataretriever import QueryResponse
@@ -16,9 +21,12 @@ from sunpy.net.fido_factory import UnifiedResponse
 from sunpy.timeseries import TimeSeries
 
 from data.db import connect_db
-from data.flux import Flux, FLUX_INDEX_NAME, FLUX_VALUE_NAME, FluxSource
+from data.flux import Flux, FLUX_INDEX_NAME, FLUX_VALUE_NAME, FluxSource, empty_flux
 from ._base import Importer, ImporterProcess
 
+# Fido search treats the end as inclusive
+_SEARCH_END_OFFSET = timedelta(milliseconds=1)
+
 warnings.filterwarnings(
     'ignore',
     message='This download has been started in a thread which is not the main thread. '
@@ -28,49 +36,132 @@ warnings.filterwarnings(
 
 def _select_best_source(day_result: QueryResponse) -> QueryResponseRow:
     # Assert that all intervals always go an entire day
-    assert day_result[0]['Start Time'].to_datetime().time() == time(0, 0, 0, 0)
-    end_times = set(day_result['End Time'])
-    assert len(end_times) == 1
-    assert end_times.pop().to_datetime().time() == time(23, 59, 59, 999000)
+    if __debug__:
+        end_times = day_result['End Time'].mjd
+        assert day_result[0]['Start Time'].to_datetime().time() == time(0, 0, 0, 0)
+        assert (end_times == end_times[0]).all()
+        assert day_result[0]['End Time'].to_datetime().time() == time(23, 59, 59, 999000)
 
-    # Select newest satellite
-    day_result.sort('SatelliteNumber', reverse=True)
-    max_sat_number = day_result[0]['SatelliteNumber']
-    day_result = day_result[day_result['SatelliteNumber'] == max_sat_number]
-    if 'Resolution' not in day_result.keys():
-        return day_result[0]
+    # Select newest satellite and within it the highest resolution.
+    # Rank with plain arrays instead of sorting and filtering the table.
+    ranks = np.asarray(day_result['SatelliteNumber']) * 2
+    if 'Resolution' in day_result.keys():
+        ranks += np.asarray(day_result['Resolution']) == 'flx1s'
+    return day_result[int(np.argmax(ranks))]
 
-    # Select highest resolution
-    high_res = day_result[day_result['Resolution'] == 'flx1s']
-    return high_res[0] if len(high_res) >= 1 else day_result[0]
 
+def _from_timeseries(timeseries: TimeSeries) -> Flux:
+    df = timeseries.to_dataframe()
+    # Mask the arrays directly instead of re-indexing the whole dataframe
+    flux = df['xrsb'].to_numpy()
+    is_valid = ~np.isnan(flux)
+    return pd.Series(
+        flux[is_valid],
+        name=FLUX_VALUE_NAME,
+        index=df.index[is_valid].tz_localize(timezone.utc).rename(FLUX_INDEX_NAME),
+    )
 
-def _next_month_start(date: datetime) -> datetime:
-    return (date.replace(day=1) + timedelta(days=32)).replace(day=1)
 
+def _load_file(path: str, start: datetime) -> Flux:
+    flux = _from_timeseries(TimeSeries(path))
+    # Slice by position to skip the label slicing machinery of .loc
+    return flux.iloc[flux.index.searchsorted(start):]
+
+
+def _concat_flux(fluxes: Iterable[Flux]) -> Flux:
+    fluxes = [flux for flux in fluxes if len(flux) > 0]
+    if len(fluxes) == 0:
+        return empty_flux()
+    # Downloaded files are not necessarily ordered by time
+    fluxes.sort(key=lambda flux: flux.index[0])
+    return pd.concat(fluxes, copy=False)
+
+
+def _next_month(year: int, month: int) -> tuple[int, int]:
+    return year + month // 12, month % 12 + 1
 
-def _from_timeseries(timeseries: TimeSeries) -> Flux:
-    df = timeseries.to_dataframe()
-    return df.set_index(
-        df.index.tz_localize(timezone.utc).rename(FLUX_INDEX_NAME)
-    ).xrsb.dropna().rename(FLUX_VALUE_NAME)
+
+def _months_between(start: datetime, end: datetime) -> Generator[tuple[int, int], None, None]:
+    """
+    :return: Year and month of every month overlapping the range, including the partial first month.
+    """
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield year, month
+        year, month = _next_month(year, month)
+
+
+def _unlink_all(paths: Iterable[str]):
+    for path in paths:
+        # Might already be gone if an earlier deletion got interrupted
+        with suppress(FileNotFoundError):
+            os.unlink(path)
+
+
+def _backoff_delay(backoff: timedelta, i_try: int) -> float:
+    """
+    Exponential backoff with jitter so parallel retries do not hit the server in lockstep.
+
+    :return: Seconds to wait before the next try.
+    """
+    return backoff.total_seconds() * 2 ** i_try * random.uniform(0.5, 1.5)
+
+
+def _is_retryable(failure: BaseException) -> bool:
+    """
+    :return: False for client errors which will fail again. Rate limits, server and network errors are retryable.
+    """
+    # parfive records HTTP errors as a FailedDownload wrapping a FailedDownload around the response.
+    # Multipart downloads hold the response in a MultiPartDownloadError instead.
+    cause = failure
+    while isinstance(cause, FailedDownload):
+        cause = cause.exception
+    if isinstance(cause, MultiPartDownloadError):
+        cause = cause.response
+    status = getattr(cause, 'status', None)
+    return status is None or status == 429 or status >= 500
 
 
 _TReturn = TypeVar('_TReturn')
 
+# Items passed between the import stages.
+# None marks the end and an exception the failure of an earlier stage.
+_Download = Union[Results, Exception, None]
+_Load = Union[tuple[Results, Flux], Exception, None]
+
 
 class ArchiveImporter(Importer):
+    max_parallel_searches: int = 4
+    max_search_retries: int = 4
+    search_backoff: timedelta = timedelta(seconds=5)
     max_download_retries: int = 4
     download_backoff: timedelta = timedelta(seconds=30)
 
-    _executor: ThreadPoolExecutor
+    _loop: AbstractEventLoop
+    _io_executor: ThreadPoolExecutor
+    _cpu_executor: ThreadPoolExecutor
 
-    def __init__(self, connection: Connection, executor: ThreadPoolExecutor):
+    def __init__(
+            self,
+            connection: Connection,
+            io_executor: ThreadPoolExecutor,
+            cpu_executor: ThreadPoolExecutor
+    ):
+        """
+        :param io_executor: Runs the blocking network and file system calls.
+        :param cpu_executor: Runs the parsing. Separate so it cannot starve the downloads.
+        """
         super().__init__(FluxSource.ARCHIVE, connection)
-        self._executor = executor
+        # Must be created inside the event loop it is used in
+        self._loop = asyncio.get_running_loop()
+        self._io_executor = io_executor
+        self._cpu_executor = cpu_executor
 
-    def _run_in_executor(self, function: Callable[..., _TReturn], *args: Any) -> Future[_TReturn]:
-        return asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+    def _run_in_io(self, function: Callable[..., _TReturn], *args: Any) -> Future[_TReturn]:
+        return self._loop.run_in_executor(self._io_executor, function, *args)
+
+    def _run_in_cpu(self, function: Callable[..., _TReturn], *args: Any) -> Future[_TReturn]:
+        return self._loop.run_in_executor(self._cpu_executor, function, *args)
 
     async def _search_month(
             self,
@@ -79,89 +170,163 @@ class ArchiveImporter(Importer):
             search_semaphore: Semaphore,
     ) -> UnifiedResponse:
         start = max(limit_start, datetime(year, month, 1, tzinfo=timezone.utc))
-        end = _next_month_start(start)
+        end = datetime(*_next_month(year, month), 1, tzinfo=timezone.utc)
+        query = (
+            attrs.Time(start, end - _SEARCH_END_OFFSET),
+            attrs.Instrument("XRS")
+        )
         async with search_semaphore:
-            results = await self._run_in_executor(
-                lambda: Fido.search(
-                    attrs.Time(
-                        start,
-                        # Search treats end as inclusive
-                        end - timedelta(milliseconds=1)
-                    ),
-                    attrs.Instrument("XRS")
-                )
-            )
-        if len(results[0]) == 0:
+            for i_try in range(self.max_search_retries + 1):
+                try:
+                    results = await self._run_in_io(Fido.search, *query)
+                    break
+                except OSError:
+                    # Network errors. Give up on the last try
+                    if i_try == self.max_search_retries:
+                        raise
+                    await asyncio.sleep(_backoff_delay(self.search_backoff, i_try))
+        table = results[0]  # noqa
+        if len(table) == 0:
             return UnifiedResponse()
+        # Split into days by sorting once and cutting at the start time changes
+        start_times = table['Start Time'].mjd
+        order = np.argsort(start_times, kind='stable')
+        table = table[order]
+        _, day_starts = np.unique(start_times[order], return_index=True)
+        day_ends = np.append(day_starts[1:], len(table))
         return UnifiedResponse(*(
-            _select_best_source(days_result)
-            for days_result in results[0].group_by('Start Time').groups
+            _select_best_source(table[day_start:day_end])
+            for day_start, day_end in zip(day_starts, day_ends)
         ))
 
     async def _download_results(self, results: UnifiedResponse) -> Results:
+        fetch = partial(
+            Fido.fetch,
+            results,
+            # Download everything at once (max days in a month).
+            max_conn=31,
+            progress=False
+        )
         for i_try in range(self.max_download_retries + 1):
-            files = await self._run_in_executor(
-                lambda: Fido.fetch(
-                    results,
-                    # Download everything at once (max days in a month).
-                    max_conn=31,
-                    progress=False
-                )
-            )
-            if len(files.errors) == 0:
+            files = await self._run_in_io(fetch)
+            if not any(_is_retryable(error.exception) for error in files.errors):
+                break
+            if i_try == self.max_download_retries:
                 break
             # Errors probably because of rate limits. Back off
-            await asyncio.sleep(
-                self.download_backoff.total_seconds() * (i_try + 1)
-            )
+            await asyncio.sleep(_backoff_delay(self.download_backoff, i_try))
         return files  # noqa
 
-    async def _load_files(self, files: Results) -> Flux:
-        return await self._run_in_executor(
-            lambda: _from_timeseries(TimeSeries(files, concatenate=True))
-        )
-
-    async def _delete_files(self, files):
-        await asyncio.gather(*(
-            self._run_in_executor(lambda p: Path(p).unlink(), path)
+    async def _load_files(self, files: Results, start: datetime) -> Flux:
+        """
+        Loads the files separately and in parallel so the data
+        before start gets dropped before the concatenation and not after.
+        """
+        fluxes = await asyncio.gather(*(
+            self._run_in_cpu(_load_file, path, start)
             for path in files
         ))
+        return await self._run_in_cpu(_concat_flux, fluxes)
+
+    async def _delete_files(self, files: list[str], pending_files: set[str]):
+        # Unlinking is cheap so a single executor job is enough for all files
+        await self._run_in_io(_unlink_all, files)
+        pending_files.difference_update(files)
+
+    async def _download_stage(
+            self,
+            result_months: list[Task[UnifiedResponse]],
+            downloads: Queue[_Download],
+            pending_files: set[str]
+    ):
+        try:
+            for results in result_months:
+                files = await self._download_results(await results)
+                if len(files) == 0:
+                    continue
+                pending_files.update(files)
+                await downloads.put(files)
+        except Exception as error:
+            # Pass the failure on so the months already in the pipeline still get imported
+            await downloads.put(error)
+            return
+        await downloads.put(None)
+
+    async def _load_stage(
+            self,
+            downloads: Queue[_Download],
+            loads: Queue[_Load],
+            start: datetime,
+            pending_files: set[str]
+    ):
+        while True:
+            files = await downloads.get()
+            if files is None or isinstance(files, Exception):
+                await loads.put(files)
+                return
+            try:
+                flux = await self._load_files(files, start)
+            except Exception as error:
+                # The month will not be imported so its files are no longer needed
+                await self._delete_files(files, pending_files)
+                await loads.put(error)
+                return
+            await loads.put((files, flux))
+
+    async def _import_stage(self, loads: Queue[_Load], pending_files: set[str]):
+        while True:
+            loaded = await loads.get()
+            if loaded is None:
+                return
+            if isinstance(loaded, Exception):
+                raise loaded
+            files, flux = loaded
+            try:
+                await self._import(flux)
+            finally:
+                await self._delete_files(files, pending_files)
 
     async def _import_from(self, start: datetime) -> timedelta:
         """
         Import from the archive as efficiently as possible.
-        Only the search is easily parallelize-able because download uses
-        the full bandwidth and the database insert locks the GIL too much.
+        The monthly searches run in parallel. Download, load and import form a pipeline
+        so that e.g. the next month downloads while the current one gets imported.
+        The queues between the stages keep the months in order and bound how many are in flight.
+        Failures travel down the queues so a started import always finishes before they get raised.
         """
-        search_semaphore = Semaphore(2)
+        search_semaphore = Semaphore(self.max_parallel_searches)
         result_months = [
             asyncio.create_task(self._search_month(
-                date.year, date.month,
+                year, month,
                 start, search_semaphore
             ))
-            for date in pd.date_range(
-                start, datetime.now(timezone.utc),
-                freq='MS'
-            )
+            for year, month in _months_between(start, datetime.now(timezone.utc))
         ]
-        for results in result_months:
-            results = await results
-            if results is None:
-                continue
-            files = await self._download_results(results)
-            if len(files) == 0:
-                continue
-            flux = await self._load_files(files)
-            await self._import(flux.loc[start:])
-            await self._delete_files(files)
+        downloads = Queue(maxsize=1)
+        loads = Queue(maxsize=1)
+        # Downloaded files not yet deleted, including the ones still waiting in the queues
+        pending_files = set()
+        try:
+            async with asyncio.TaskGroup() as stages:
+                stages.create_task(self._download_stage(result_months, downloads, pending_files))
+                stages.create_task(self._load_stage(downloads, loads, start, pending_files))
+                stages.create_task(self._import_stage(loads, pending_files))
+        finally:
+            for search in result_months:
+                search.cancel()
+            if len(pending_files) > 0:
+                await self._delete_files(list(pending_files), pending_files)
         return timedelta(hours=1)
 
 
 async def start_archive_import():
     connection = await connect_db()
     try:
-        with ThreadPoolExecutor() as executor:
-            importer = ArchiveImporter(connection, executor)
+        with (
+            ThreadPoolExecutor(thread_name_prefix='archive-io') as io_executor,
+            ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='archive-cpu') as cpu_executor
+        ):
+            importer = ArchiveImporter(connection, io_executor, cpu_executor)
             await importer.start_import()
     finally:
         await connection.close()
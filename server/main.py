@@ -1,11 +1,10 @@
 from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import cast, Optional
+from typing import Optional
 
 import asyncpg
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from pandas import Timestamp
 
 from data.db import create_db_pool
 from data.flux import fetch_flux
@@ -51,7 +50,9 @@ async def get_flux(
     # TODO: investigate time inaccuracy (live data is not minute aligned)
     async with db_pool.acquire() as connection:
         series = await fetch_flux(connection, min(max(resolution, 1), 2000), start, end)
-        return [
-            (cast(Timestamp, timestamp).timestamp() * 1000, flux)
-            for timestamp, flux in series.items()
-        ]
+        # Convert whole arrays to epoch milliseconds instead of each timestamp separately
+        return list(zip(
+            # Pin the unit because the index resolution is not always nanoseconds
+            (series.index.as_unit('ns').asi8 / 1e6).tolist(),
+            series.tolist()
+        ))